@@ -1,29 +1,61 @@
 #!/usr/bin/env python3
 """
 Advanced Load Balancer Implementation
-Supports multiple algorithms: Round Robin, Weighted Round Robin, Least Connections
+Supports multiple algorithms: Round Robin, Weighted Round Robin, Least Connections,
+Random and Power of Two Choices
 """
 
 import time
 import threading
+import asyncio
 import yaml
 import requests
-from typing import List, Dict, Optional
-from dataclasses import dataclass
+import aiohttp
+from requests.adapters import HTTPAdapter
+from typing import List, Dict, Deque, Mapping, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
 from enum import Enum
 import random
-from collections import defaultdict
+import itertools
+import heapq
+from collections import defaultdict, deque
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of recent response times kept per server
+RESPONSE_TIME_WINDOW = 10
+
+# How long a get_server_stats snapshot is served before being rebuilt (seconds)
+STATS_CACHE_TTL = 0.25
+
+# Hop-by-hop headers are meaningful only for a single connection and are never forwarded
+_HOP_BY_HOP = frozenset({
+    'connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade'
+})
+_HOP_BY_HOP_LENGTHS = frozenset(len(name) for name in _HOP_BY_HOP)
+
+# Size of the chunks a proxied response body is relayed in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def strip_hop_by_hop_headers(headers: Mapping[str, str]) -> Dict:
+    """Copy headers, leaving out the hop-by-hop ones (matched case-insensitively)"""
+    # Only a name of one of the hop-by-hop lengths can match, so most keys are
+    # never lowercased and no throwaway string is allocated for them
+    return {
+        k: v for k, v in headers.items()
+        if len(k) not in _HOP_BY_HOP_LENGTHS or k.lower() not in _HOP_BY_HOP
+    }
+
 class LoadBalancingAlgorithm(Enum):
     ROUND_ROBIN = "round_robin"
     WEIGHTED_ROUND_ROBIN = "weighted_round_robin"
     LEAST_CONNECTIONS = "least_connections"
     RANDOM = "random"
+    P2C = "p2c"
 
 @dataclass
 class Server:
@@ -37,11 +69,15 @@ class Server:
     active_connections: int = 0
     total_requests: int = 0
     last_health_check: float = 0.0
-    response_times: List[float] = None
+    last_good_ts: float = 0.0  # time.monotonic() of the last proxied 2xx response
+    skipped_health_checks: int = 0  # consecutive rounds skipped thanks to recent good traffic
+    response_times: Deque[float] = None
+    _rt_sum: float = field(default=0.0, init=False, repr=False)
+    _rt_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
     
     def __post_init__(self):
         if self.response_times is None:
-            self.response_times = []
+            self.response_times = deque(maxlen=RESPONSE_TIME_WINDOW)
     
     @property
     def url(self) -> str:
@@ -55,20 +91,50 @@ class Server:
     def avg_response_time(self) -> float:
         if not self.response_times:
             return 0.0
-        return sum(self.response_times) / len(self.response_times)
+        return self._rt_sum / len(self.response_times)
+    
+    def record_response_time(self, response_time: float):
+        """Record a response time, keeping a running sum over the window"""
+        # Health checks and request threads both record, so keep the sum consistent
+        with self._rt_lock:
+            if len(self.response_times) == self.response_times.maxlen:
+                self._rt_sum -= self.response_times[0]
+            self.response_times.append(response_time)
+            self._rt_sum += response_time
 
 class LoadBalancer:
     def __init__(self, config_file: str = "config.yaml"):
         self.config = self._load_config(config_file)
         self.servers: List[Server] = []
-        self.current_index = 0
+        self._rr_counter = itertools.count()
+        # (healthy server tuple, one expanded weighted round robin cycle over it)
+        self._wrr_schedule: Tuple[Optional[Sequence[Server]], Tuple[Server, ...]] = (None, ())
+        self._healthy_cache: Tuple[Server, ...] = ()
+        self._healthy_dirty = True
+        self._healthy_lock = threading.Lock()
+        self._stats_cache: Optional[Tuple[float, Dict]] = None
+        # Least connections min-heap of (active_connections, version, server); an entry
+        # is live only while its version is the latest one recorded for that server
+        self._lc_heap: List[Tuple[int, int, Server]] = []
+        self._lc_version: Dict[str, int] = {}
+        self._lc_seq = itertools.count()
+        self._lc_servers: Optional[Sequence[Server]] = None
+        self._lc_members: set = set()
+        self._lc_lock = threading.Lock()
         self.algorithm = LoadBalancingAlgorithm(self.config['load_balancer']['algorithm'])
         self.health_check_interval = self.config['load_balancer']['health_check_interval']
+        self.health_check_deadline = self.config['load_balancer'].get('health_check_deadline', 0.5)
+        self.max_skipped_health_checks = self.config['load_balancer'].get('max_skipped_health_checks', 2)
         self.timeout = self.config['load_balancer']['timeout']
         self.health_check_thread = None
         self.running = False
+        self._health_loop = None
+        self._health_check_future = None
+        self._health_probes: Dict[str, asyncio.Task] = {}
+        self._session = requests.Session()
         
         self._initialize_servers()
+        self._mount_connection_pools()
         self._start_health_checking()
     
     def _load_config(self, config_file: str) -> Dict:
@@ -97,47 +163,122 @@ class LoadBalancer:
             self.servers.append(server)
             logger.info(f"Added server: {server.name} at {server.url}")
     
+    def _mount_connection_pools(self):
+        """Mount a keep-alive connection pool for each backend origin"""
+        for server in self.servers:
+            adapter = HTTPAdapter(pool_connections=len(self.servers), pool_maxsize=64, max_retries=0)
+            self._session.mount(server.url, adapter)
+    
     def _start_health_checking(self):
-        """Start health checking in a separate thread"""
+        """Start health checking on an event loop in a separate thread"""
         self.running = True
-        self.health_check_thread = threading.Thread(target=self._health_check_loop, daemon=True)
+        self._health_loop = asyncio.new_event_loop()
+        self.health_check_thread = threading.Thread(target=self._run_health_loop, daemon=True)
         self.health_check_thread.start()
+        self._health_check_future = asyncio.run_coroutine_threadsafe(self._health_check_loop(), self._health_loop)
         logger.info("Health checking started")
     
-    def _health_check_loop(self):
+    def _run_health_loop(self):
+        """Run the health check event loop until the health check coroutine stops it"""
+        asyncio.set_event_loop(self._health_loop)
+        self._health_loop.run_forever()
+        self._health_loop.close()
+    
+    async def _health_check_loop(self):
         """Continuous health checking loop"""
-        while self.running:
-            for server in self.servers:
-                if server.enabled:
-                    self._check_server_health(server)
-            time.sleep(self.health_check_interval)
+        try:
+            # One session for the process lifetime; its connector keeps probe sockets alive
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+                try:
+                    while self.running:
+                        await self._health_check_once(session)
+                        await asyncio.sleep(self.health_check_interval)
+                finally:
+                    for probe in self._health_probes.values():
+                        probe.cancel()
+        finally:
+            asyncio.get_running_loop().stop()
+    
+    async def _health_check_once(self, session: aiohttp.ClientSession):
+        """Probe all enabled servers concurrently, waiting at most health_check_deadline"""
+        now = time.monotonic()
+        pending: Dict[asyncio.Task, Server] = {}
+        missed: List[Server] = []
+        for server in self.servers:
+            if not server.enabled:
+                continue
+            # A server that just answered real traffic successfully doesn't need a probe, but
+            # it still gets one every few rounds so a draining /health is eventually seen
+            if (now - server.last_good_ts < self.health_check_interval
+                    and server.skipped_health_checks < self.max_skipped_health_checks):
+                server.skipped_health_checks += 1
+                continue
+            server.skipped_health_checks = 0
+            # Never stack a second probe on a server whose previous one is still hanging;
+            # a probe carried over from an earlier round counts as missed whatever it answers
+            probe = self._health_probes.get(server.name)
+            if probe is not None and not probe.done():
+                missed.append(server)
+                continue
+            probe = asyncio.ensure_future(self._check_server_health(session, server))
+            self._health_probes[server.name] = probe
+            pending[probe] = server
+        
+        stragglers = set()
+        if pending:
+            done, stragglers = await asyncio.wait(pending, timeout=self.health_check_deadline)
+            for probe in done:
+                # An unexpected error counts as a failed probe instead of killing the loop
+                self._set_server_health(pending[probe], probe.exception() is None and probe.result())
+        # Leave late probes running rather than tearing down their sockets; their answers
+        # are never applied, and the server gets a fresh probe once the old one finishes
+        for server in [pending[probe] for probe in stragglers] + missed:
+            self._set_server_health(server, False)
+            logger.warning(f"Health check for {server.name} missed the {self.health_check_deadline}s deadline")
+        
+        # Wall clock on purpose: last_health_check is reported through /admin/stats
+        checked_at = time.time()
+        for server in [*pending.values(), *missed]:
+            server.last_health_check = checked_at
     
-    def _check_server_health(self, server: Server):
-        """Check health of a single server"""
+    async def _check_server_health(self, session: aiohttp.ClientSession, server: Server) -> bool:
+        """Check health of a single server, returning whether it answered 200"""
         try:
-            start_time = time.time()
-            response = requests.get(server.health_url, timeout=5)
-            response_time = time.time() - start_time
-            
-            server.healthy = response.status_code == 200
-            server.last_health_check = time.time()
+            start_time = time.monotonic()
+            async with session.get(server.health_url) as response:
+                # Read the body so the connection is returned to the pool
+                await response.read()
+            response_time = time.monotonic() - start_time
             
             # Track response time (keep last 10 measurements)
-            server.response_times.append(response_time)
-            if len(server.response_times) > 10:
-                server.response_times.pop(0)
+            server.record_response_time(response_time)
             
-            status = "healthy" if server.healthy else "unhealthy"
+            healthy = response.status == 200
+            status = "healthy" if healthy else "unhealthy"
             logger.debug(f"Health check for {server.name}: {status} (response time: {response_time:.3f}s)")
+            return healthy
             
-        except requests.RequestException as e:
-            server.healthy = False
-            server.last_health_check = time.time()
-            logger.warning(f"Health check failed for {server.name}: {e}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Health check failed for {server.name}: {str(e) or 'timed out'}")
+            return False
     
-    def get_healthy_servers(self) -> List[Server]:
-        """Get list of healthy and enabled servers"""
-        return [server for server in self.servers if server.enabled and server.healthy]
+    def _set_server_health(self, server: Server, healthy: bool):
+        """Record a health check result, invalidating the healthy server cache on change"""
+        if server.healthy != healthy:
+            server.healthy = healthy
+            self._healthy_dirty = True
+    
+    def get_healthy_servers(self) -> Tuple[Server, ...]:
+        """Get healthy and enabled servers, rebuilt only after a health or enabled flip"""
+        if self._healthy_dirty:
+            with self._healthy_lock:
+                if self._healthy_dirty:
+                    # Clear the flag first so a flip during the rebuild is not lost
+                    self._healthy_dirty = False
+                    self._healthy_cache = tuple(
+                        server for server in self.servers if server.enabled and server.healthy
+                    )
+        return self._healthy_cache
     
     def select_server(self) -> Optional[Server]:
         """Select a server based on the configured algorithm"""
@@ -158,85 +299,156 @@ class LoadBalancer:
             return self._least_connections_selection(healthy_servers)
         elif self.algorithm == LoadBalancingAlgorithm.RANDOM:
             return random.choice(healthy_servers)
+        elif self.algorithm == LoadBalancingAlgorithm.P2C:
+            return self._p2c_selection(healthy_servers)
         else:
             return self._round_robin_selection(healthy_servers)
     
-    def _round_robin_selection(self, servers: List[Server]) -> Server:
+    def _round_robin_selection(self, servers: Sequence[Server]) -> Server:
         """Round robin server selection"""
-        server = servers[self.current_index % len(servers)]
-        self.current_index += 1
-        return server
+        # next() on itertools.count is atomic under the GIL, so concurrent
+        # request threads never read the same index or lose an increment
+        return servers[next(self._rr_counter) % len(servers)]
     
-    def _weighted_round_robin_selection(self, servers: List[Server]) -> Server:
+    def _weighted_round_robin_selection(self, servers: Sequence[Server]) -> Server:
         """Weighted round robin server selection"""
-        # Create a list with servers repeated according to their weight
-        weighted_servers = []
-        for server in servers:
-            weighted_servers.extend([server] * server.weight)
-        
-        server = weighted_servers[self.current_index % len(weighted_servers)]
-        self.current_index += 1
-        return server
+        source, schedule = self._wrr_schedule
+        # get_healthy_servers hands out a new tuple whenever the healthy set changes
+        if source is not servers:
+            schedule = self._build_wrr_schedule(servers)
+            self._wrr_schedule = (servers, schedule)
+        return schedule[next(self._rr_counter) % len(schedule)]
+    
+    @staticmethod
+    def _build_wrr_schedule(servers: Sequence[Server]) -> Tuple[Server, ...]:
+        """Expand one full cycle of smooth weighted round robin (as used by nginx)"""
+        # Every server gains its weight, the leader is picked and pays back the total,
+        # which interleaves picks instead of sending bursts to heavy servers
+        total = sum(server.weight for server in servers)
+        current = [0] * len(servers)
+        schedule = []
+        for _ in range(total):
+            for i, server in enumerate(servers):
+                current[i] += server.weight
+            best = max(range(len(servers)), key=current.__getitem__)
+            current[best] -= total
+            schedule.append(servers[best])
+        return tuple(schedule)
     
-    def _least_connections_selection(self, servers: List[Server]) -> Server:
+    def _least_connections_selection(self, servers: Sequence[Server]) -> Server:
         """Select server with least active connections"""
+        with self._lc_lock:
+            # get_healthy_servers hands out a new tuple whenever the healthy set changes
+            if servers is not self._lc_servers:
+                self._rebuild_lc_heap(servers)
+            heap = self._lc_heap
+            while heap and self._lc_version[heap[0][2].name] != heap[0][1]:
+                heapq.heappop(heap)
+            if heap:
+                return heap[0][2]
         return min(servers, key=lambda s: s.active_connections)
     
-    def forward_request(self, method: str, path: str, headers: Dict, data: Optional[bytes] = None) -> tuple:
-        """Forward request to selected server"""
+    def _p2c_selection(self, servers: Sequence[Server]) -> Server:
+        """Power of two choices: the less loaded of two randomly sampled servers"""
+        a, b = random.sample(servers, 2)
+        return a if a.active_connections <= b.active_connections else b
+    
+    def _rebuild_lc_heap(self, servers: Sequence[Server]):
+        """Rebuild the least connections heap from current counts (caller holds _lc_lock)"""
+        self._lc_servers = servers
+        self._lc_members = {server.name for server in servers}
+        self._lc_heap = []
+        for server in servers:
+            version = next(self._lc_seq)
+            self._lc_version[server.name] = version
+            self._lc_heap.append((server.active_connections, version, server))
+        heapq.heapify(self._lc_heap)
+    
+    def _adjust_connections(self, server: Server, delta: int):
+        """Change a server's active connection count and refresh its heap entry"""
+        with self._lc_lock:
+            server.active_connections = max(0, server.active_connections + delta)
+            if server.name not in self._lc_members:
+                return
+            version = next(self._lc_seq)
+            self._lc_version[server.name] = version
+            heapq.heappush(self._lc_heap, (server.active_connections, version, server))
+            # Superseded entries are only popped once they reach the top, so compact
+            # before they pile up behind the live ones
+            if len(self._lc_heap) > 4 * len(self._lc_members):
+                self._rebuild_lc_heap(self._lc_servers)
+    
+    def forward_request(self, method: str, path: str, headers: Mapping[str, str], data: Optional[bytes] = None) -> tuple:
+        """Forward request to selected server
+        
+        Returns (response, status_code, body, close). On success body is an iterator over
+        the still-encoded upstream body and the caller must call close once it is sent;
+        on failure response and close are None and body is an error message.
+        """
         server = self.select_server()
         
         if not server:
-            return None, 503, "No healthy servers available"
+            return None, 503, "No healthy servers available", None
         
+        streaming = False
         try:
             # Increment connection count
-            server.active_connections += 1
+            self._adjust_connections(server, 1)
             server.total_requests += 1
             
-            # Prepare request
+            # Prepare request, dropping hop-by-hop headers
             url = f"{server.url}{path}"
-            request_headers = dict(headers)
+            request_headers = strip_hop_by_hop_headers(headers)
+            # Keep the pooled upstream connection open regardless of what the client asked for
+            request_headers['Connection'] = 'keep-alive'
             
-            # Remove hop-by-hop headers
-            hop_by_hop_headers = [
-                'connection', 'keep-alive', 'proxy-authenticate',
-                'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade'
-            ]
-            for header in hop_by_hop_headers:
-                request_headers.pop(header, None)
-            
-            # Forward request
-            start_time = time.time()
-            response = requests.request(
+            # Forward request (monotonic clock: immune to wall clock steps)
+            start_time = time.monotonic()
+            response = self._session.request(
                 method=method,
                 url=url,
                 headers=request_headers,
                 data=data,
                 timeout=self.timeout,
-                allow_redirects=False
+                allow_redirects=False,
+                stream=True
             )
-            response_time = time.time() - start_time
+            finished_at = time.monotonic()
+            response_time = finished_at - start_time
             
             # Track response time
-            server.response_times.append(response_time)
-            if len(server.response_times) > 10:
-                server.response_times.pop(0)
+            server.record_response_time(response_time)
+            if 200 <= response.status_code < 300:
+                server.last_good_ts = finished_at
             
             logger.info(f"Request forwarded to {server.name}: {method} {path} -> {response.status_code} ({response_time:.3f}s)")
             
-            return response, response.status_code, response.text
+            def close():
+                # The server stays busy until its body has been relayed, not just its headers
+                response.close()
+                self._adjust_connections(server, -1)
+            
+            # Relay the body as it arrives instead of buffering and decoding it
+            body = response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+            streaming = True
+            return response, response.status_code, body, close
             
         except requests.RequestException as e:
             logger.error(f"Request failed to {server.name}: {e}")
-            return None, 502, f"Bad Gateway: {str(e)}"
+            return None, 502, f"Bad Gateway: {str(e)}", None
         
         finally:
-            # Decrement connection count
-            server.active_connections = max(0, server.active_connections - 1)
+            # Decrement connection count here only if no close callback took it over
+            if not streaming:
+                self._adjust_connections(server, -1)
     
     def get_server_stats(self) -> Dict:
-        """Get statistics for all servers"""
+        """Get statistics for all servers, cached briefly to absorb dashboard polling"""
+        now = time.monotonic()
+        cached = self._stats_cache
+        if cached and now - cached[0] < STATS_CACHE_TTL:
+            return cached[1]
+        
         stats = {
             'algorithm': self.algorithm.value,
             'total_servers': len(self.servers),
@@ -258,13 +470,15 @@ class LoadBalancer:
             }
             stats['servers'].append(server_stats)
         
+        self._stats_cache = (now, stats)
         return stats
     
     def update_algorithm(self, algorithm: str):
         """Update load balancing algorithm"""
         try:
             self.algorithm = LoadBalancingAlgorithm(algorithm)
-            self.current_index = 0  # Reset round robin index
+            self._rr_counter = itertools.count()  # Reset round robin index
+            self._stats_cache = None
             logger.info(f"Load balancing algorithm changed to: {algorithm}")
         except ValueError:
             logger.error(f"Invalid algorithm: {algorithm}")
@@ -274,6 +488,8 @@ class LoadBalancer:
         for server in self.servers:
             if server.name == server_name:
                 server.enabled = enabled
+                self._healthy_dirty = True
+                self._stats_cache = None
                 logger.info(f"Server {server_name} {'enabled' if enabled else 'disabled'}")
                 return True
         logger.warning(f"Server {server_name} not found")
@@ -282,6 +498,10 @@ class LoadBalancer:
     def shutdown(self):
         """Shutdown the load balancer"""
         self.running = False
+        if self._health_check_future:
+            # Cancelling unwinds the coroutine, which closes its session and stops the loop
+            self._health_check_future.cancel()
         if self.health_check_thread:
             self.health_check_thread.join(timeout=5)
+        self._session.close()
         logger.info("Load balancer shutdown complete")
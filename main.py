@@ -6,7 +6,7 @@ Main Load Balancer Application
 import time
 import signal
 import sys
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify
 from load_balancer import LoadBalancer
 import logging
 
@@ -16,8 +16,11 @@ logger = logging.getLogger(__name__)
 import time
 import signal
 import sys
-from flask import Flask, request, jsonify, render_template_string
-from load_balancer import LoadBalancer
+import gzip
+from flask import Flask, Response, request, jsonify
+from waitress import serve
+import orjson
+from load_balancer import LoadBalancer, strip_hop_by_hop_headers
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -90,6 +93,10 @@ USER_STATUS_TEMPLATE = """
 </body>
 """
 
+def _json_response(data, status=200):
+    """Build a JSON response with orjson, which encodes floats far faster than jsonify"""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
 class LoadBalancerApp:
     def __init__(self, config_file="config.yaml"):
         self.load_balancer = LoadBalancer(config_file)
@@ -97,21 +104,32 @@ class LoadBalancerApp:
         self.setup_routes()
 
     def setup_routes(self):
-        @self.app.route('/', methods=['GET'])
+        # Compile templates once rather than re-parsing them on every request; the
+        # landing page and dashboard take no context, so render them up front too
+        landing_page_html = self.app.jinja_env.from_string(LANDING_PAGE_TEMPLATE).render()
+        dashboard_html = self.app.jinja_env.from_string(DASHBOARD_TEMPLATE).render().encode()
+        dashboard_gzip = gzip.compress(dashboard_html, compresslevel=6)
+        user_status_template = self.app.jinja_env.from_string(USER_STATUS_TEMPLATE)
+
+        # The portal has its own prefix so that / itself is balanced like any other path
+        @self.app.route('/portal', methods=['GET'])
         def landing_page():
-            return render_template_string(LANDING_PAGE_TEMPLATE)
+            return landing_page_html
 
         @self.app.route('/user', methods=['GET'])
         def user_status():
-            return render_template_string(USER_STATUS_TEMPLATE, stats=self.load_balancer.get_server_stats())
+            return user_status_template.render(stats=self.load_balancer.get_server_stats())
 
         @self.app.route('/admin/dashboard')
         def dashboard():
-            return render_template_string(DASHBOARD_TEMPLATE)
+            if request.accept_encodings['gzip']:
+                return Response(dashboard_gzip, mimetype='text/html',
+                                headers={'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+            return Response(dashboard_html, mimetype='text/html', headers={'Vary': 'Accept-Encoding'})
 
         @self.app.route('/admin/stats')
         def get_stats():
-            return jsonify(self.load_balancer.get_server_stats())
+            return _json_response(self.load_balancer.get_server_stats())
 
         @self.app.route('/admin/algorithm/<algorithm>', methods=['POST'])
         def change_algorithm(algorithm):
@@ -131,15 +149,34 @@ class LoadBalancerApp:
             else:
                 return jsonify({'error': 'Server not found'}), 404
 
+        @self.app.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'])
+        @self.app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'])
+        def proxy(path):
+            upstream_path = request.full_path if request.query_string else request.path
+            response, status, body, close = self.load_balancer.forward_request(
+                request.method, upstream_path, request.headers, request.get_data()
+            )
+            if response is None:
+                return jsonify({'error': body}), status
+            proxied = Response(body, status=status, headers=strip_hop_by_hop_headers(response.headers))
+            # Hand the upstream connection back to the pool and release the server's
+            # connection slot once the body has been sent
+            proxied.call_on_close(close)
+            return proxied
+
 
     def run(self, host="0.0.0.0", port=8080):
-        """Run the load balancer"""
+        """Run the load balancer under the multi-threaded waitress WSGI server"""
+        threads = self.load_balancer.config['load_balancer'].get('threads', 32)
         logger.info(f"Starting Load Balancer on {host}:{port}")
         logger.info(f"Algorithm: {self.load_balancer.algorithm.value}")
         logger.info(f"Backend servers: {len(self.load_balancer.servers)}")
+        logger.info(f"Worker threads: {threads}")
         try:
-            self.app.run(host=host, port=port, debug=False, use_reloader=False)
-        except KeyboardInterrupt:
+            # Each forwarded request blocks a worker on upstream I/O, so size the pool for concurrency
+            serve(self.app, host=host, port=port, threads=threads)
+        finally:
+            # waitress handles Ctrl+C itself and returns, so clean up on any exit
             logger.info("Shutting down load balancer...")
             self.load_balancer.shutdown()
 
@@ -285,6 +322,7 @@ DASHBOARD_TEMPLATE = """
             <button class="btn" onclick="changeAlgorithm('weighted_round_robin')">Weighted Round Robin</button>
             <button class="btn" onclick="changeAlgorithm('least_connections')">Least Connections</button>
             <button class="btn" onclick="changeAlgorithm('random')">Random</button>
+            <button class="btn" onclick="changeAlgorithm('p2c')">Power of Two Choices</button>
         </div>
         
         <div class="servers-table">
@@ -14,7 +14,7 @@ fi
 
 # Check if required packages are installed
 echo "📦 Checking dependencies..."
-python3 -c "import flask, requests, yaml" 2>/dev/null
+python3 -c "import flask, requests, yaml, aiohttp, waitress, orjson, fastapi, uvicorn" 2>/dev/null
 if [ $? -ne 0 ]; then
     echo "⚠️  Installing required packages..."
     pip3 install -r requirements.txt
@@ -55,6 +55,7 @@ echo ""
 echo "✅ Demo is ready!"
 echo "================================"
 echo "🌐 Load Balancer: http://localhost:8080"
+echo "🏠 Portal: http://localhost:8080/portal"
 echo "📊 Dashboard: http://localhost:8080/admin/dashboard"
 echo "📈 Stats API: http://localhost:8080/admin/stats"
 echo ""
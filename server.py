@@ -5,96 +5,191 @@ Simple HTTP Server for testing load balancer
 
 import time
 import random
-from flask import Flask, jsonify, request
+from collections import deque
+import asyncio
+from fastapi import FastAPI, Response
+import uvicorn
+import orjson
+import requests
 import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import signal
 import sys
 
+# Number of simulated delays drawn per refill
+DELAY_BATCH_SIZE = 1024
+
+# How often the cached timestamp reported in responses is refreshed (seconds)
+CLOCK_RESOLUTION = 0.001
+
+# How often the prebuilt /health responses are rebuilt with a fresh timestamp (nanoseconds)
+HEALTH_REFRESH_INTERVAL_NS = 100_000_000
+
+def _json_body(body, status=200):
+    """Wrap JSON bytes serialized with orjson in a response, bypassing FastAPI's stdlib-based encoding"""
+    return Response(body, status_code=status, media_type="application/json")
+
+def _json_prefix(payload):
+    """Serialize the constant leading fields of an object, left open for more fields"""
+    return orjson.dumps(payload)[:-1] + b','
+
+class _HealthShortcut:
+    """ASGI wrapper serving GET /health before FastAPI routing runs; the app has no /health route of its own"""
+    
+    def __init__(self, app, server):
+        self.app = app
+        self.server = server
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == '/health' and scope['method'] == 'GET':
+            await self.server.health_response()(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
 class TestServer:
     def __init__(self, name, port, delay_range=(0.1, 0.5)):
         self.name = name
         self.port = port
         self.delay_range = delay_range
-        self.app = Flask(name)
+        # Simulated delays are drawn in batches and handed out until the buffer runs dry
+        self._delays = deque()
+        self._refill_delays()
+        # Only the timestamp and delay change per request; serialize the rest once
+        self._home_prefix = _json_prefix({'server': name, 'port': port, 'message': f'Hello from {name}!'})
+        self._health_prefixes = {
+            True: _json_prefix({'server': name, 'status': 'healthy'}),
+            False: _json_prefix({'server': name, 'status': 'unhealthy'}),
+        }
+        self._heavy_prefix = _json_prefix({'server': name, 'message': 'Heavy task completed'})
+        # The toggle reply has no changing fields, so both variants are serialized up front
+        self._toggle_bodies = {
+            healthy: orjson.dumps({
+                'server': name,
+                'status': 'healthy' if healthy else 'unhealthy',
+                'message': f'Health status toggled to {"healthy" if healthy else "unhealthy"}'
+            })
+            for healthy in (True, False)
+        }
+        # Handlers report this cached timestamp, in integer nanoseconds since the epoch,
+        # instead of reading the clock per request
+        self._now_ns = time.time_ns()
+        self._rebuild_health_responses()
+        threading.Thread(target=self._tick_clock, daemon=True).start()
+        # Each server lives in its own process, so skip the generated API docs it would never serve
+        self.app = FastAPI(title=name, docs_url=None, redoc_url=None, openapi_url=None)
         self.setup_routes()
         self.healthy = True
         
     def setup_routes(self):
-        @self.app.route('/')
-        def home():
-            # Simulate some processing time
-            delay = random.uniform(*self.delay_range)
-            time.sleep(delay)
+        @self.app.get('/')
+        async def home():
+            # Simulate some processing time without holding up other requests
+            if not self._delays:
+                self._refill_delays()
+            delay = self._delays.popleft()
+            await asyncio.sleep(delay)
             
-            return jsonify({
-                'server': self.name,
-                'port': self.port,
-                'message': f'Hello from {self.name}!',
-                'timestamp': time.time(),
+            return _json_body(self._home_prefix + orjson.dumps({
+                'timestamp': self._now_ns,
                 'delay': delay
-            })
-        
-        @self.app.route('/health')
-        def health():
-            status = 'healthy' if self.healthy else 'unhealthy'
-            return jsonify({
-                'server': self.name,
-                'status': status,
-                'timestamp': time.time()
-            }), 200 if self.healthy else 503
+            })[1:])
         
-        @self.app.route('/toggle-health')
-        def toggle_health():
+        @self.app.get('/toggle-health')
+        async def toggle_health():
             self.healthy = not self.healthy
-            return jsonify({
-                'server': self.name,
-                'status': 'healthy' if self.healthy else 'unhealthy',
-                'message': f'Health status toggled to {"healthy" if self.healthy else "unhealthy"}'
-            })
+            return _json_body(self._toggle_bodies[self.healthy])
         
-        @self.app.route('/heavy')
-        def heavy_task():
+        @self.app.get('/heavy')
+        async def heavy_task():
             # Simulate heavy processing
-            time.sleep(2)
-            return jsonify({
-                'server': self.name,
-                'message': 'Heavy task completed',
-                'timestamp': time.time()
-            })
+            await asyncio.sleep(2)
+            return _json_body(self._heavy_prefix + orjson.dumps({
+                'timestamp': self._now_ns
+            })[1:])
+    
+    def health_response(self):
+        """The prebuilt /health response for the current health status"""
+        return self._health_responses[self.healthy]
+    
+    def _refill_delays(self):
+        """Draw the next batch of fresh simulated delays"""
+        low, high = self.delay_range
+        span = high - low
+        rand = random.random
+        self._delays.extend([low + span * rand() for _ in range(DELAY_BATCH_SIZE)])
+    
+    def _rebuild_health_responses(self):
+        """Prebuild the healthy and unhealthy /health responses around the cached timestamp"""
+        timestamp = orjson.dumps({'timestamp': self._now_ns})[1:]
+        self._health_responses = {
+            True: _json_body(self._health_prefixes[True] + timestamp, 200),
+            False: _json_body(self._health_prefixes[False] + timestamp, 503),
+        }
+    
+    def _tick_clock(self):
+        """Keep the cached timestamp current to within CLOCK_RESOLUTION"""
+        last_rebuild = self._now_ns
+        while True:
+            self._now_ns = time.time_ns()
+            if self._now_ns - last_rebuild >= HEALTH_REFRESH_INTERVAL_NS:
+                self._rebuild_health_responses()
+                last_rebuild = self._now_ns
+            time.sleep(CLOCK_RESOLUTION)
     
     def run(self):
         print(f"Starting {self.name} on port {self.port}")
-        self.app.run(host='127.0.0.1', port=self.port, debug=False, use_reloader=False)
+        # loop/http "auto" pick uvloop and httptools when installed (they are not on Windows)
+        uvicorn.run(_HealthShortcut(self.app, self), host='127.0.0.1', port=self.port, log_level="warning", loop="auto", http="auto")
+
+def _run_test_server(name, port):
+    """Process entry point; the server is built in the child since apps can't be pickled"""
+    TestServer(name, port).run()
+
+def _wait_until_ready(session, port, timeout=2.0):
+    """Poll a server's /health endpoint with exponential backoff until it answers"""
+    deadline = time.monotonic() + timeout
+    backoff = 0.01
+    while time.monotonic() < deadline:
+        try:
+            session.get(f"http://127.0.0.1:{port}/health", timeout=0.1)
+            return True
+        except requests.RequestException:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 0.08)
+    print(f"Server on port {port} did not become ready within {timeout}s")
+    return False
 
 def create_test_servers():
     """Create and start test servers"""
-    servers = []
+    ports = [8000 + i for i in range(1, 4)]
+    processes = []
     
-    # Create 3 test servers
-    for i in range(1, 4):
-        port = 8000 + i
-        server = TestServer(f"server{i}", port)
-        servers.append(server)
+    # Start all 3 test servers at once, each in its own process so they don't share a GIL
+    for i, port in enumerate(ports, 1):
+        process = multiprocessing.Process(target=_run_test_server, args=(f"server{i}", port), daemon=True)
+        process.start()
+        processes.append(process)
     
-    # Start servers in separate threads
-    threads = []
-    for server in servers:
-        thread = threading.Thread(target=server.run, daemon=True)
-        thread.start()
-        threads.append(thread)
-        time.sleep(0.5)  # Stagger server starts
+    # Then wait for all of them to answer /health in parallel
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        list(executor.map(lambda port: _wait_until_ready(session, port), ports))
     
-    return servers, threads
+    return processes
 
 def signal_handler(sig, frame):
     print('\nShutting down servers...')
+    for process in multiprocessing.active_children():
+        process.terminate()
     sys.exit(0)
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
+    # run_demo.sh stops its jobs with a plain kill; the child processes must not outlive us
+    signal.signal(signal.SIGTERM, signal_handler)
     
     print("Creating test servers for load balancer...")
-    servers, threads = create_test_servers()
+    processes = create_test_servers()
     
     print("\nTest servers started:")
     print("- Server 1: http://127.0.0.1:8001")
@@ -108,8 +203,12 @@ if __name__ == "__main__":
     print("\nPress Ctrl+C to stop all servers")
     
     try:
-        # Keep main thread alive
-        while True:
-            time.sleep(1)
+        # Keep main thread alive, blocked until a signal arrives
+        if hasattr(signal, 'pause'):
+            signal.pause()
+        else:
+            # Windows has no signal.pause(); a long sleep still lets Ctrl+C through
+            while True:
+                time.sleep(3600)
     except KeyboardInterrupt:
         signal_handler(None, None)
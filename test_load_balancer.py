@@ -3,43 +3,77 @@
 Test script for the load balancer
 """
 
-import requests
 import time
 import threading
 import json
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import aiohttp
+import orjson
+from collections import Counter
 
-def test_basic_requests():
+# Most requests the tests keep in flight against the load balancer at once
+MAX_IN_FLIGHT = 50
+IN_FLIGHT = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+# Longest wait for the balancer to notice a health change. A server busy with good
+# traffic may go unprobed for up to max_skipped_health_checks + 1 intervals (15s with
+# the default config), plus the probe deadline
+HEALTH_WAIT_TIMEOUT = 20
+
+def create_session():
+    """One keep-alive connection pool shared by every test, sized for the concurrent tests"""
+    connector = aiohttp.TCPConnector(limit=MAX_IN_FLIGHT, keepalive_timeout=30)
+    # Ask for reusable, uncompressed responses; aiohttp already skips environment proxy lookups
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=15),
+        headers={"Connection": "keep-alive", "Accept-Encoding": "identity"},
+    )
+
+async def fetch_json(session, method, url, **kwargs):
+    """Send a request and decode its JSON body with orjson"""
+    async with IN_FLIGHT, session.request(method, url, **kwargs) as response:
+        return await response.json(loads=orjson.loads)
+
+async def wait_for_health(session, server_name, healthy, timeout=HEALTH_WAIT_TIMEOUT):
+    """Poll /admin/stats until server_name reports the wanted health, returning the last stats"""
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = await fetch_json(session, "GET", "http://localhost:8080/admin/stats")
+        server = next(s for s in stats['servers'] if s['name'] == server_name)
+        if server['healthy'] == healthy or time.monotonic() >= deadline:
+            return stats
+        await asyncio.sleep(0.5)
+
+async def test_basic_requests(session):
     """Test basic load balancer functionality"""
     print("🧪 Testing basic load balancer functionality...")
     
     # Test multiple requests
     for i in range(5):
         try:
-            response = requests.get("http://localhost:8080/", timeout=5)
-            data = response.json()
+            data = await fetch_json(session, "GET", "http://localhost:8080/", timeout=aiohttp.ClientTimeout(total=5))
             print(f"Request {i+1}: {data['server']} - {data['message']}")
         except Exception as e:
             print(f"Request {i+1} failed: {e}")
     
     print("✅ Basic requests test completed\n")
 
-def test_algorithm_switching():
+async def test_algorithm_switching(session):
     """Test switching between different algorithms"""
     print("🔄 Testing algorithm switching...")
     
-    algorithms = ["round_robin", "weighted_round_robin", "least_connections", "random"]
+    algorithms = ["round_robin", "weighted_round_robin", "least_connections", "random", "p2c"]
     
     for algorithm in algorithms:
         print(f"Switching to {algorithm}...")
         try:
-            response = requests.post(f"http://localhost:8080/admin/algorithm/{algorithm}")
-            print(f"Response: {response.json()}")
+            response = await fetch_json(session, "POST", f"http://localhost:8080/admin/algorithm/{algorithm}")
+            print(f"Response: {response}")
             
-            # Test a few requests with new algorithm
-            for i in range(3):
-                resp = requests.get("http://localhost:8080/")
-                data = resp.json()
+            # Test a few requests with new algorithm, issued together
+            results = await asyncio.gather(*(fetch_json(session, "GET", "http://localhost:8080/") for _ in range(3)))
+            for data in results:
                 print(f"  {algorithm}: {data['server']}")
             
         except Exception as e:
@@ -47,31 +81,31 @@ def test_algorithm_switching():
     
     print("✅ Algorithm switching test completed\n")
 
-def test_server_management():
+async def test_server_management(session):
     """Test enabling/disabling servers"""
     print("🔧 Testing server management...")
     
     try:
         # Get initial stats
-        stats = requests.get("http://localhost:8080/admin/stats").json()
+        stats = await fetch_json(session, "GET", "http://localhost:8080/admin/stats")
         print(f"Initial healthy servers: {stats['healthy_servers']}")
         
         # Disable a server
         print("Disabling server1...")
-        response = requests.post("http://localhost:8080/admin/server/server1/disable")
-        print(f"Response: {response.json()}")
+        response = await fetch_json(session, "POST", "http://localhost:8080/admin/server/server1/disable")
+        print(f"Response: {response}")
         
         # Check stats after disabling
-        stats = requests.get("http://localhost:8080/admin/stats").json()
+        stats = await fetch_json(session, "GET", "http://localhost:8080/admin/stats")
         print(f"Healthy servers after disabling: {stats['healthy_servers']}")
         
         # Re-enable the server
         print("Re-enabling server1...")
-        response = requests.post("http://localhost:8080/admin/server/server1/enable")
-        print(f"Response: {response.json()}")
+        response = await fetch_json(session, "POST", "http://localhost:8080/admin/server/server1/enable")
+        print(f"Response: {response}")
         
         # Check stats after re-enabling
-        stats = requests.get("http://localhost:8080/admin/stats").json()
+        stats = await fetch_json(session, "GET", "http://localhost:8080/admin/stats")
         print(f"Healthy servers after re-enabling: {stats['healthy_servers']}")
         
     except Exception as e:
@@ -79,71 +113,67 @@ def test_server_management():
     
     print("✅ Server management test completed\n")
 
-def test_concurrent_requests():
+async def test_concurrent_requests(session):
     """Test concurrent requests to see load distribution"""
     print("⚡ Testing concurrent requests...")
     
-    def make_request(request_id):
+    async def make_request(request_id):
         try:
-            response = requests.get("http://localhost:8080/", timeout=10)
-            data = response.json()
-            return f"Request {request_id}: {data['server']}"
+            data = await fetch_json(session, "GET", "http://localhost:8080/", timeout=aiohttp.ClientTimeout(total=10))
+            return request_id, data['server'], None
         except Exception as e:
-            return f"Request {request_id} failed: {e}"
+            return request_id, None, e
     
     # Make 20 concurrent requests
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(make_request, i) for i in range(20)]
-        results = [future.result() for future in futures]
+    results = await asyncio.gather(*(make_request(i) for i in range(20)))
     
     # Count server distribution
-    server_counts = {}
-    for result in results:
-        if "server" in result:
-            server = result.split(": ")[1]
-            server_counts[server] = server_counts.get(server, 0) + 1
+    server_counts = Counter(server for _, server, err in results if err is None)
+    for request_id, _, err in results:
+        if err is not None:
+            print(f"  Request {request_id} failed: {err}")
     
     print("Server distribution:")
-    for server, count in server_counts.items():
+    for server, count in server_counts.most_common():
         print(f"  {server}: {count} requests")
     
     print("✅ Concurrent requests test completed\n")
 
-def test_health_checking():
+async def test_health_checking(session):
     """Test health checking functionality"""
     print("🏥 Testing health checking...")
     
     try:
         # Get initial stats
-        stats = requests.get("http://localhost:8080/admin/stats").json()
+        stats = await fetch_json(session, "GET", "http://localhost:8080/admin/stats")
         print("Initial server status:")
         for server in stats['servers']:
             print(f"  {server['name']}: {'Healthy' if server['healthy'] else 'Unhealthy'}")
         
         # Simulate server failure by toggling health
         print("\nSimulating server1 failure...")
-        requests.get("http://localhost:8001/toggle-health")
+        await fetch_json(session, "GET", "http://localhost:8001/toggle-health")
         
         # Wait for health check to detect the failure
         print("Waiting for health check to detect failure...")
-        time.sleep(6)
+        start_time = time.monotonic()
+        stats = await wait_for_health(session, "server1", False)
         
         # Check stats after failure
-        stats = requests.get("http://localhost:8080/admin/stats").json()
-        print("Server status after failure:")
+        print(f"Server status after failure ({time.monotonic() - start_time:.1f}s):")
         for server in stats['servers']:
             print(f"  {server['name']}: {'Healthy' if server['healthy'] else 'Unhealthy'}")
         
         # Restore server health
         print("\nRestoring server1 health...")
-        requests.get("http://localhost:8001/toggle-health")
+        await fetch_json(session, "GET", "http://localhost:8001/toggle-health")
         
         # Wait for health check to detect recovery
-        time.sleep(6)
+        start_time = time.monotonic()
+        stats = await wait_for_health(session, "server1", True)
         
         # Check stats after recovery
-        stats = requests.get("http://localhost:8080/admin/stats").json()
-        print("Server status after recovery:")
+        print(f"Server status after recovery ({time.monotonic() - start_time:.1f}s):")
         for server in stats['servers']:
             print(f"  {server['name']}: {'Healthy' if server['healthy'] else 'Unhealthy'}")
         
@@ -152,31 +182,36 @@ def test_health_checking():
     
     print("✅ Health checking test completed\n")
 
-def test_heavy_requests():
+async def test_heavy_requests(session):
     """Test handling of heavy requests"""
     print("🏋️ Testing heavy requests...")
     
-    def make_heavy_request(request_id):
+    async def make_heavy_request(request_id):
         start_time = time.time()
         try:
-            response = requests.get("http://localhost:8080/heavy", timeout=15)
-            end_time = time.time()
-            data = response.json()
-            return f"Request {request_id}: {data['server']} (took {end_time - start_time:.2f}s)"
+            data = await fetch_json(session, "GET", "http://localhost:8080/heavy")
+            return request_id, data['server'], time.time() - start_time, None
         except Exception as e:
-            return f"Request {request_id} failed: {e}"
+            return request_id, None, time.time() - start_time, e
     
     # Make 3 concurrent heavy requests
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        futures = [executor.submit(make_heavy_request, i) for i in range(3)]
-        results = [future.result() for future in futures]
+    start_time = time.time()
+    results = await asyncio.gather(*(make_heavy_request(i) for i in range(3)))
+    total_time = time.time() - start_time
     
-    for result in results:
-        print(f"  {result}")
+    for request_id, server, elapsed, err in results:
+        if err is None:
+            print(f"  Request {request_id}: {server} (took {elapsed:.2f}s)")
+        else:
+            print(f"  Request {request_id} failed: {err}")
+    print(f"  All heavy requests finished in {total_time:.2f}s")
+    
+    server_counts = Counter(server for _, server, _, err in results if err is None)
+    print(f"  Spread: {', '.join(f'{server}: {count}' for server, count in server_counts.most_common())}")
     
     print("✅ Heavy requests test completed\n")
 
-def main():
+async def main():
     """Run all tests"""
     print("🚀 Starting Load Balancer Tests\n")
     print("Make sure the load balancer and test servers are running!")
@@ -184,24 +219,26 @@ def main():
     print("Test servers: http://localhost:8001, 8002, 8003\n")
     
     # Wait a moment for user to read
-    time.sleep(2)
+    await asyncio.sleep(2)
     
-    try:
-        # Test basic connectivity
-        response = requests.get("http://localhost:8080/admin/stats", timeout=5)
-        print("✅ Load balancer is accessible\n")
-    except Exception as e:
-        print(f"❌ Cannot connect to load balancer: {e}")
-        print("Please make sure the load balancer is running on port 8080")
-        return
-    
-    # Run all tests
-    test_basic_requests()
-    test_algorithm_switching()
-    test_server_management()
-    test_concurrent_requests()
-    test_health_checking()
-    test_heavy_requests()
+    async with create_session() as session:
+        try:
+            # Test basic connectivity
+            await fetch_json(session, "GET", "http://localhost:8080/admin/stats", timeout=aiohttp.ClientTimeout(total=5))
+            print("✅ Load balancer is accessible\n")
+        except Exception as e:
+            print(f"❌ Cannot connect to load balancer: {e}")
+            print("Please make sure the load balancer is running on port 8080")
+            return
+    
+        # Run all tests; each prints its own report, and overlapping the traffic
+        # tests would both interleave that output and skew their distributions
+        await test_basic_requests(session)
+        await test_algorithm_switching(session)
+        await test_server_management(session)
+        await test_concurrent_requests(session)
+        await test_health_checking(session)
+        await test_heavy_requests(session)
     
     print("🎉 All tests completed!")
     print("\nYou can also:")
@@ -210,4 +247,4 @@ def main():
     print("- Check stats: curl http://localhost:8080/admin/stats")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())